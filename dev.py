@@ -11,7 +11,7 @@ async def main():
     assert len(result) == 4
     print(result)
     print(type(result))
-    result = struct.pack(">4H", *result)
+    result = result.astype(">u2", copy=False).tobytes()
     print(result)
     print(type(result), len(result))
     result = struct.unpack_from(">f", buffer=result, offset=4)
@@ -0,0 +1,334 @@
+# Copyright (c) 2023, ZIH, Technische Universitaet Dresden, Federal Republic of Germany
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#       and/or other materials provided with the distribution.
+#     * Neither the name of metricq nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import asyncio
+import socket
+import struct
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, NamedTuple, Optional
+
+from metricq.logging import get_logger
+
+logger = get_logger()
+
+
+MBAP_HEADER_SIZE = 7
+"""Size of the modbus application protocol header of modbus TCP in bytes"""
+
+MAX_PDU_SIZE = 253
+"""Maximum size of a modbus protocol data unit in bytes"""
+
+RECEIVE_BUFFER_SIZE = 4096
+"""Size of the reused receive buffer, must be able to hold at least one frame"""
+
+KEEPALIVE_IDLE = 10
+"""Seconds of idle time before TCP keepalive probes are sent"""
+
+KEEPALIVE_INTERVAL = 5
+"""Seconds between TCP keepalive probes"""
+
+KEEPALIVE_COUNT = 3
+"""Number of unanswered TCP keepalive probes before the connection is dropped"""
+
+READ_INPUT_REGISTERS = 0x04
+"""Function code for reading input registers"""
+
+_MBAP_HEADER = struct.Struct(">HHHB")
+"""Transaction identifier, protocol identifier, length and unit identifier"""
+
+_READ_REQUEST = struct.Struct(">HHHBBHH")
+"""MBAP header followed by function code, starting address and quantity"""
+
+
+class ModbusError(Exception):
+    pass
+
+
+def configure_socket(sock: Optional[socket.socket]) -> None:
+    """
+    Disable Nagle's algorithm, which would delay the tiny modbus requests, and
+    enable keepalive so that dead connections are noticed even between requests.
+    """
+    if sock is None:
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The fine tuning options are not available on every platform
+    for option, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class _Transaction(NamedTuple):
+    future: asyncio.Future[None]
+    function_code: int
+    buffer: bytearray
+    """Destination for the data of the response"""
+
+
+class ModbusClient(asyncio.BufferedProtocol):
+    """
+    Modbus TCP client that allows multiple requests to be in flight on the same
+    connection. Responses are matched to their requests by the transaction
+    identifier in the MBAP header, so they may also arrive out of order.
+    Callers acquire :attr:`request_semaphore` around their requests to limit the
+    number of concurrent requests, which allows them to take timestamps right
+    before sending.
+
+    Data is received into a buffer that is reused for the whole connection and
+    response data is copied from there into the buffer given by the caller,
+    without allocating intermediate objects per frame.
+    """
+
+    def __init__(self, max_requests_in_flight: int = 1) -> None:
+        self.request_semaphore = asyncio.Semaphore(max_requests_in_flight)
+        self._transport: Optional[asyncio.Transport] = None
+        self._receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._receive_view = memoryview(self._receive_buffer)
+        self._receive_end = 0
+        self._transaction_id = 0
+        self._pending: dict[int, _Transaction] = {}
+        self._closed: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.done()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        self._transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        error = exc if exc is not None else ConnectionError("Connection closed")
+        for transaction in self._pending.values():
+            if not transaction.future.done():
+                transaction.future.set_exception(error)
+        self._pending.clear()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._receive_view[self._receive_end :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._receive_end += nbytes
+        position = 0
+        while self._receive_end - position >= MBAP_HEADER_SIZE:
+            transaction_id, protocol_id, length, _ = _MBAP_HEADER.unpack_from(
+                self._receive_buffer, position
+            )
+            # The unit identifier is followed by at least a function code and
+            # either an exception code or a byte count
+            if protocol_id != 0 or not 3 <= length <= MAX_PDU_SIZE + 1:
+                self._abort(ModbusError("Invalid MBAP header"))
+                return
+            frame_end = position + MBAP_HEADER_SIZE - 1 + length
+            if frame_end > self._receive_end:
+                break  # Wait for the rest of the frame
+            self._complete(
+                transaction_id,
+                self._receive_view[position + MBAP_HEADER_SIZE : frame_end],
+            )
+            position = frame_end
+
+        # Move the incomplete remainder to the front, this is at most one frame
+        remainder = self._receive_end - position
+        if position != 0 and remainder != 0:
+            self._receive_view[:remainder] = self._receive_view[
+                position : self._receive_end
+            ]
+        self._receive_end = remainder
+
+    def _complete(self, transaction_id: int, pdu: memoryview) -> None:
+        transaction = self._pending.pop(transaction_id, None)
+        if transaction is None or transaction.future.done():
+            logger.warning("Unexpected modbus transaction {}", transaction_id)
+            return
+
+        function_code = transaction.function_code
+        if pdu[0] == function_code | 0x80:
+            transaction.future.set_exception(
+                ModbusError(
+                    f"Modbus exception code {pdu[1]} for function code {function_code}"
+                )
+            )
+        elif pdu[0] != function_code:
+            transaction.future.set_exception(
+                ModbusError(f"Unexpected function code {pdu[0]} in response")
+            )
+        elif pdu[1] != len(transaction.buffer) or len(pdu) != 2 + pdu[1]:
+            transaction.future.set_exception(
+                ModbusError(f"Invalid response size {len(pdu)}")
+            )
+        else:
+            transaction.buffer[:] = pdu[2:]
+            transaction.future.set_result(None)
+
+    def _abort(self, error: Exception) -> None:
+        assert self._transport is not None
+        self._transport.abort()
+        # connection_lost will be called with None after abort
+        self.connection_lost(error)
+
+    def _next_transaction_id(self) -> int:
+        while True:
+            self._transaction_id = (self._transaction_id + 1) % 0x10000
+            if self._transaction_id not in self._pending:
+                return self._transaction_id
+
+    async def _read_registers(
+        self,
+        function_code: int,
+        slave_id: int,
+        starting_address: int,
+        buffer: bytearray,
+    ) -> None:
+        if self._transport is None or self._closed.done():
+            raise ConnectionError("Modbus connection is closed")
+
+        transaction_id = self._next_transaction_id()
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._pending[transaction_id] = _Transaction(future, function_code, buffer)
+        try:
+            self._transport.write(
+                _READ_REQUEST.pack(
+                    transaction_id,
+                    0,
+                    _READ_REQUEST.size - MBAP_HEADER_SIZE + 1,
+                    slave_id,
+                    function_code,
+                    starting_address,
+                    len(buffer) // 2,
+                )
+            )
+            await future
+        finally:
+            self._pending.pop(transaction_id, None)
+
+    async def read_input_registers_into(
+        self, slave_id: int, starting_address: int, buffer: bytearray
+    ) -> None:
+        """
+        Read input registers (function code 04) into the given buffer.
+        The number of registers is determined by the buffer size, the raw
+        big-endian register contents are written to it.
+        """
+        await self._read_registers(
+            READ_INPUT_REGISTERS, slave_id, starting_address, buffer
+        )
+
+    async def read_input_registers(
+        self, slave_id: int, starting_address: int, quantity: int
+    ) -> bytearray:
+        """
+        Read input registers (function code 04).
+        Returns the raw big-endian register contents.
+        """
+        buffer = bytearray(2 * quantity)
+        await self.read_input_registers_into(slave_id, starting_address, buffer)
+        return buffer
+
+    async def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+        await self._closed
+
+
+async def open_client(
+    host: str, port: int, max_requests_in_flight: int = 1
+) -> ModbusClient:
+    transport, client = await asyncio.get_running_loop().create_connection(
+        lambda: ModbusClient(max_requests_in_flight), host, port
+    )
+    configure_socket(transport.get_extra_info("socket"))
+    return client
+
+
+class _PooledConnection:
+    def __init__(self, connecting: asyncio.Task[ModbusClient]):
+        self.connecting = connecting
+        self.users = 0
+
+    @property
+    def broken(self) -> bool:
+        if not self.connecting.done():
+            return False
+        return (
+            self.connecting.cancelled()
+            or self.connecting.exception() is not None
+            or self.connecting.result().closed
+        )
+
+    async def close(self) -> None:
+        if not self.connecting.done():
+            self.connecting.cancel()
+            with suppress(asyncio.CancelledError, Exception):
+                await self.connecting
+        elif not self.connecting.cancelled() and self.connecting.exception() is None:
+            await self.connecting.result().close()
+
+
+class ConnectionPool:
+    """
+    Shares one connection per endpoint between all users, e.g., hosts that query
+    different slaves behind the same gateway. A connection is closed once the last
+    user releases it, broken connections are replaced on the next request.
+    The request limit applies per connection, so users with different limits
+    get separate connections.
+    """
+
+    def __init__(self) -> None:
+        self._connections: dict[tuple[str, int, int], _PooledConnection] = {}
+
+    @asynccontextmanager
+    async def connect(
+        self, host: str, port: int, max_requests_in_flight: int = 1
+    ) -> AsyncIterator[ModbusClient]:
+        key = (host, port, max_requests_in_flight)
+        connection = self._connections.get(key)
+        if connection is None or connection.broken:
+            connection = _PooledConnection(
+                asyncio.create_task(open_client(host, port, max_requests_in_flight))
+            )
+            self._connections[key] = connection
+
+        connection.users += 1
+        try:
+            # Shielded, such that one cancelled user does not cancel the others
+            yield await asyncio.shield(connection.connecting)
+        finally:
+            connection.users -= 1
+            if connection.users == 0:
+                if self._connections.get(key) is connection:
+                    del self._connections[key]
+                await connection.close()
@@ -1,15 +1,44 @@
+from functools import lru_cache
 from typing import Optional
 
-from pydantic import BaseModel
-from pydantic.config import Extra
+import hostlist  # type: ignore
+from pydantic import BaseModel, TypeAdapter
 from pydantic.fields import Field
 from pydantic.functional_validators import field_validator
 from pydantic.types import NonNegativeInt, PositiveFloat, PositiveInt
 
-_model_config = {"extra": "forbid", "frozen": True}
+__all__ = [
+    "Metric",
+    "Group",
+    "StringConfig",
+    "Host",
+    "Source",
+    "SOURCE_ADAPTER",
+    "expand_hostlist",
+]
+
+
+@lru_cache(maxsize=1024)
+def expand_hostlist(hosts: str) -> tuple[str, ...]:
+    """
+    Expand a hostlist string such as ``foo[4-6,8].example.com``.
+    Cached, because the same hostlists are expanded again on every configuration
+    update. Returns a tuple so the cached result cannot be modified.
+    """
+    return tuple(hostlist.expand_hostlist(hosts))
+
+
+_model_config = {
+    "extra": "forbid",
+    "frozen": True,
+    "revalidate_instances": "never",
+    "defer_build": False,
+}
 """
 Extra parameters are forbidden and will raise validation errors.
 The parameters will not be mutable.
+Nested model instances are not validated again,
+and the validators are built when the classes are defined.
 """
 
 
@@ -39,15 +68,9 @@ class Group(BaseModel, **_model_config):
     A string can also be used that will be parsed by MetricQ exactly, e.g. ``100ms``.
     If omitted, the global interval will be used.
     """
-    metrics: dict[str, Metric]
+    metrics: dict[str, Metric] = Field(..., min_length=1)
     """Dictionary of metrics, keys are the metric names prefixed by the host name"""
 
-    @field_validator("metrics")
-    def metrics_not_empty(cls, v: dict[str, Metric]) -> dict[str, Metric]:
-        if len(v) == 0:
-            raise ValueError("Group must have at least one metric")
-        return v
-
     double_sample: bool = False
     """
     If set to true, the metric will be sampled twice per configured interval.
@@ -85,6 +108,21 @@ class Host(BaseModel, **_model_config):
     """
     slave_id: int
     """Slave ID to query"""
+    max_requests_in_flight: PositiveInt = 1
+    """
+    Maximum number of requests that are sent to the host without waiting for the
+    responses. Only increase this for devices that can handle pipelined requests.
+    Hosts with the same address, port and limit share a single connection,
+    e.g., different slaves behind one gateway, and the limit applies to all of them.
+    """
+    coalesce_max_gap: NonNegativeInt = 0
+    """
+    Maximum number of unconfigured registers between two groups that are read
+    with a single request, if ``coalesce`` is enabled for the source.
+    By default only adjacent or overlapping groups are merged. Only increase this
+    if the device answers reads of unmapped registers instead of reporting an
+    illegal data address.
+    """
     description: str = ""
     """
     Description prefix for metadata of all included metrics.
@@ -104,11 +142,21 @@ class Host(BaseModel, **_model_config):
 
 
 # We cannot forbid because of magic couchdb fields in the config e.g. `_id`
-class Source(BaseModel, extra=Extra.ignore, frozen=True):
+class Source(BaseModel, **{**_model_config, "extra": "ignore"}):
     interval: PositiveFloat | PositiveInt | str | None = None
     """
     Default query interval in seconds.
     A string can also be used that will be parsed by MetricQ exactly, e.g. ``100ms``.
     If omitted, the global interval will be used.
     """
+    coalesce: bool = True
+    """
+    Merge groups of a host with the same interval into a single request, if their
+    register ranges are adjacent, see also ``coalesce_max_gap`` of the hosts.
+    Groups with ``double_sample`` are never merged.
+    """
     hosts: list[Host] = Field(..., min_length=1)
+
+
+SOURCE_ADAPTER = TypeAdapter(Source)
+"""Validator for source configurations, built once at import time"""
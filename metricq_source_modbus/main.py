@@ -52,4 +52,5 @@ click_completion.init()
 @click_log.simple_verbosity_option(logger)  # type: ignore
 def run(server, token) -> None:
     src = ModbusSource(url=server, token=token)
+    # Agent.run installs uvloop as the event loop whenever it is available
     src.run()
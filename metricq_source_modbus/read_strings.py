@@ -1,11 +1,11 @@
 import asyncio
-import struct
-from string import Template
+import re
 from typing import Optional
 
 from async_modbus import AsyncClient, AsyncTCPClient  # type: ignore
 from metricq.logging import get_logger
 
+from metricq_source_modbus.client import configure_socket
 from metricq_source_modbus.config_model import StringConfig
 
 logger = get_logger()
@@ -18,25 +18,49 @@ async def _read_string(client: AsyncClient, slave_id: int, config: StringConfig)
         slave_id, config.address, num_registers
     )
     assert len(raw_values) == num_registers
-    buffer = struct.pack(f">{len(raw_values)}H", *raw_values)
-    if (first_null := buffer.find(b"\x00")) != -1:
-        buffer = buffer[:first_null]
-    return buffer.decode("ASCII", errors="ignore")
+    buffer: bytes = raw_values.astype(">u2", copy=False).tobytes()
+    # Strings are terminated by the first null byte, if any
+    return buffer.partition(b"\x00")[0].decode("ASCII", errors="ignore")
+
+
+_IDENTIFIER = re.compile(r"[_a-z][_a-z0-9]*", re.IGNORECASE | re.ASCII)
+"""Placeholder names as accepted by :class:`string.Template`"""
 
 
 class StringReplacer:
+    """
+    Replaces ``$foo`` and ``${foo}`` placeholders like
+    :meth:`string.Template.safe_substitute`, but with a pattern that is compiled
+    once for the known keys instead of matching every identifier.
+    """
+
     def __init__(self, mapping: dict[str, str]):
         self._mapping = {key: self.sanitize(value) for key, value in mapping.items()}
+        keys = "|".join(
+            re.escape(key) for key in self._mapping if _IDENTIFIER.fullmatch(key)
+        )
+        if keys:
+            self._pattern = re.compile(
+                rf"\$(?:(?P<escaped>\$)|(?P<named>{keys})(?![_a-zA-Z0-9])"
+                rf"|{{(?P<braced>{keys})}})"
+            )
+        else:
+            self._pattern = re.compile(r"\$(?P<escaped>\$)")
 
     @classmethod
     def sanitize(self, value: str) -> str:
         """Replace Bacnet special characters with our beautiful MetricQ dots"""
         return value.replace("'", ".").replace("`", ".").replace("´", ".").strip()
 
+    def _replace(self, match: re.Match[str]) -> str:
+        if match["escaped"]:
+            return "$"
+        return self._mapping[match["named"] or match["braced"]]
+
     def __call__(self, description: str) -> str:
         if not self._mapping:
             return description
-        return Template(description).safe_substitute(self._mapping)
+        return self._pattern.sub(self._replace, description)
 
 
 async def read_strings(
@@ -49,6 +73,7 @@ async def read_strings(
 
     async with asyncio.timeout(5):
         reader, writer = await asyncio.open_connection(host, port)
+        configure_socket(writer.get_extra_info("socket"))
         client = AsyncTCPClient((reader, writer))
         values = {
             key: await _read_string(client, slave_id, config)
@@ -27,16 +27,15 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import asyncio
-import struct
-from contextlib import suppress
-from typing import Any, AsyncIterator, Optional, Sequence, cast
+from typing import Any, AsyncIterator, Optional, Sequence
 
-from async_modbus import AsyncClient, AsyncTCPClient  # type: ignore
-from hostlist import expand_hostlist  # type: ignore
+import numpy as np
 from metricq import JsonDict, MetadataDict, Source, Timedelta, Timestamp, rpc_handler
 from metricq.logging import get_logger
+from metricq.source_metric import SourceMetric
 
 from . import config_model
+from .client import ConnectionPool, ModbusClient
 from .read_strings import StringReplacer, read_strings
 from .version import __version__  # noqa: F401 # magic import for automatic version
 
@@ -52,6 +51,9 @@ BYTES_PER_REGISTER = 2
 CONNECTION_FAILURE_RETRY_INTERVAL = 10
 """Interval in seconds to retry connecting to a host after a connection failure"""
 
+MAX_REGISTERS_PER_REQUEST = 125
+"""Maximum number of registers that can be read with a single modbus request"""
+
 
 def combine_name(prefix: str, name: str) -> str:
     prefix = prefix.rstrip(".")
@@ -81,6 +83,71 @@ def extract_interval(
     return Timedelta.from_string(config.interval)
 
 
+def _register_range(config: config_model.Group) -> tuple[int, int]:
+    start = min(metric.address for metric in config.metrics.values())
+    end = max(
+        metric.address + REGISTERS_PER_VALUE for metric in config.metrics.values()
+    )
+    return start, end
+
+
+def coalesce_groups(
+    configs: Sequence[config_model.Group],
+    default_interval: Optional[Timedelta],
+    max_gap: int = 0,
+) -> list[config_model.Group]:
+    """
+    Merge groups with the same interval that are adjacent in the register address
+    space, such that they can be read with a single request.
+    Up to ``max_gap`` unconfigured registers between two groups are read as well.
+    Groups with double sampling are kept unchanged and returned first, because
+    duplicates are detected per group and a merged group would only skip values
+    that are unchanged in all of the original groups.
+    The other groups are ordered by interval, in the order they first occur,
+    and then by register address.
+    """
+    coalesced = [config for config in configs if config.double_sample]
+    buckets: dict[Optional[Timedelta], list[config_model.Group]] = {}
+    for config in configs:
+        if config.double_sample:
+            continue
+        interval = extract_interval(config)
+        if interval is None:
+            interval = default_interval
+        buckets.setdefault(interval, []).append(config)
+
+    for bucket in buckets.values():
+        bucket.sort(key=lambda config: _register_range(config)[0])
+        current = bucket[0]
+        for config in bucket[1:]:
+            current_start, current_end = _register_range(current)
+            start, end = _register_range(config)
+            if (
+                start - current_end <= max_gap
+                and max(end, current_end) - current_start <= MAX_REGISTERS_PER_REQUEST
+                and not current.metrics.keys() & config.metrics.keys()
+            ):
+                # model_copy skips validation, both sets of metrics are validated
+                # already and the merged set is not empty
+                current = current.model_copy(
+                    update={"metrics": {**current.metrics, **config.metrics}}
+                )
+            else:
+                coalesced.append(current)
+                current = config
+        coalesced.append(current)
+    return coalesced
+
+
+def chunk_complete(source_metric: SourceMetric) -> bool:
+    """
+    Whether :meth:`metricq.SourceMetric.send` would flush the chunk after appending.
+    Mirrors its condition, ``test_chunk_complete_like_send`` keeps them in sync.
+    """
+    chunk_size = source_metric.chunk_size
+    return chunk_size is not None and len(source_metric.chunk.time_delta) >= chunk_size
+
+
 class ConfigError(Exception):
     pass
 
@@ -112,6 +179,9 @@ class Metric:
         self.address = config.address
         self.unit = config.unit
 
+        # Register offset within the group, set once the group base address is known
+        self.offset = 0
+
     @property
     def num_registers(self) -> int:
         """For now we assume float values, so two registers per value"""
@@ -136,17 +206,16 @@ class Metric:
             metadata["unit"] = self.unit
         return metadata
 
-    @property
-    def offset(self) -> int:
-        offset = self.address - self.group.base_address
-        assert offset >= 0, "offset non-negative"
-        return offset
-
-    async def update(self, timestamp: Timestamp, buffer: bytes) -> None:
-        (value,) = struct.unpack_from(
-            ">f", buffer=buffer, offset=(self.offset * BYTES_PER_REGISTER)
-        )
-        await self._source_metric.send(timestamp, value)
+    def update(self, timestamp: Timestamp, value: float) -> bool:
+        """
+        Append the value without suspending.
+        Returns whether the chunk is complete and must be flushed.
+        """
+        self._source_metric.append(timestamp, value)
+        return chunk_complete(self._source_metric)
+
+    async def flush(self) -> None:
+        await self._source_metric.flush()
 
 
 class MetricGroup:
@@ -157,8 +226,6 @@ class MetricGroup:
     - common address space (based on addresses within the metrics)
     """
 
-    _previous_buffer: Optional[bytes] = None
-
     def _create_metrics(self, metrics: dict[str, config_model.Metric]) -> list[Metric]:
         return [
             Metric(
@@ -191,84 +258,82 @@ class MetricGroup:
         )
         self._num_registers = end_address - self.base_address
 
+        for metric in self._metrics:
+            metric.offset = metric.address - self.base_address
+            assert metric.offset >= 0, "offset non-negative"
+
+        # The buffers are allocated once and reused for every request
+        self._buffer = bytearray(self._num_registers * BYTES_PER_REGISTER)
+        self._values = self._float_view(self._buffer)
+        self._previous_buffer = bytearray(len(self._buffer))
+        self._previous_values = self._float_view(self._previous_buffer)
+        self._has_previous_buffer = False
+
+        # Per-metric data for the polling loop is kept in parallel sequences:
+        # register offsets to decode all values of a poll in one go and the bound
+        # methods to pass them on without attribute lookups per value.
+        self._value_offsets = np.array(
+            [metric.offset for metric in self._metrics], dtype=np.intp
+        )
+        self._metric_updates = [metric.update for metric in self._metrics]
+        self._metric_flushes = [metric.flush for metric in self._metrics]
+
+    def _float_view(self, buffer: bytearray) -> np.ndarray[Any, np.dtype[np.float32]]:
+        """
+        View of the big-endian float starting at each register of the buffer,
+        without copying. The views overlap, which allows values at any address.
+        """
+        return np.ndarray(
+            shape=(self._num_registers - REGISTERS_PER_VALUE + 1,),
+            dtype=">f4",
+            buffer=buffer,
+            strides=(BYTES_PER_REGISTER,),
+        )
+
     @property
     def metadata(self) -> dict[str, MetadataDict]:
         return {metric.name: metric.metadata for metric in self._metrics}
 
     @property
-    def _sampling_interval(self) -> Timedelta:
+    def sampling_interval(self) -> Timedelta:
         if self._double_sample:
             return self.interval // 2
         return self.interval
 
-    async def task(
-        self,
-        stop_future: asyncio.Future[None],
-        client: AsyncClient,
-        lock: asyncio.Lock,
-    ) -> None:
-        # Similar code as to metricq.IntervalSource.task, but for individual MetricGroups
-        deadline = Timestamp.now()
-        deadline -= (
-            deadline % self._sampling_interval
-        )  # Align deadlines to the interval
-        while True:
-            await self._update(client, lock)
-
-            now = Timestamp.now()
-            deadline += self._sampling_interval
-
-            if (missed := (now - deadline)) > Timedelta(0):
-                missed_intervals = 1 + (missed // self._sampling_interval)
-                logger.warning(
-                    "Missed deadline {} by {} it is now {} (x{})",
-                    deadline,
-                    missed,
-                    now,
-                    missed_intervals,
-                )
-                deadline += self._sampling_interval * missed_intervals
-
-            timeout = deadline - now
-            done, pending = await asyncio.wait(
-                (asyncio.create_task(asyncio.sleep(timeout.s)), stop_future),
-                return_when=asyncio.FIRST_COMPLETED,
-            )
-            if stop_future in done:
-                for task in pending:  # cancel pending sleep task
-                    task.cancel()
-                stop_future.result()  # potentially raise exceptions
-                return
-
-    async def _update(
-        self,
-        client: AsyncClient,
-        lock: asyncio.Lock,
-    ) -> None:
-        # We must lock here because modbus cannot handle parallel requests
-        async with lock:
+    async def update(self, client: ModbusClient) -> None:
+        # Most devices cannot handle many (or any) parallel requests
+        async with client.request_semaphore:
             timestamp = Timestamp.now()
-            raw_values = await client.read_input_registers(
-                self.host.slave_id, self.base_address, self._num_registers
+            await client.read_input_registers_into(
+                self.host.slave_id, self.base_address, self._buffer
             )
-        assert len(raw_values) == self._num_registers
-        buffer = struct.pack(f">{len(raw_values)}H", *raw_values)
 
         duration = Timestamp.now() - timestamp
         logger.debug(f"Request finished successfully in {duration}")
 
         # TODO insert small sleep and see if that helps align stuff
 
+        values = self._values[self._value_offsets]
+
         if self._double_sample:
-            if self._previous_buffer is not None and self._previous_buffer == buffer:
+            # Comparing the raw frames is a memcmp that stops at the first difference
+            if self._has_previous_buffer and self._previous_buffer == self._buffer:
                 logger.debug("Skipping double sample")
-                self._previous_buffer = None  # Skip only one buffer
+                self._has_previous_buffer = False  # Skip only one buffer
                 return
-            self._previous_buffer = buffer
-
-        await asyncio.gather(
-            *(metric.update(timestamp, buffer) for metric in self._metrics)
-        )
+            # Keep the frame by swapping the buffers, the next request will
+            # overwrite the older one
+            self._buffer, self._previous_buffer = self._previous_buffer, self._buffer
+            self._values, self._previous_values = self._previous_values, self._values
+            self._has_previous_buffer = True
+
+        # Only flushing a complete chunk suspends, so there is no need to create
+        # a coroutine per value. A plain loop also keeps the submission order.
+        for update, flush, value in zip(
+            self._metric_updates, self._metric_flushes, values.tolist()
+        ):
+            if update(timestamp, value):
+                await flush()
 
 
 class Host:
@@ -287,16 +352,26 @@ class Host:
         self._port = config.port
         self.metric_prefix = name
         self.slave_id = config.slave_id
+        self._max_requests_in_flight = config.max_requests_in_flight
         self.description = replacer(f"{config.description} {description}".strip())
 
+        group_configs: Sequence[config_model.Group] = config.groups
+        if source.coalesce:
+            group_configs = coalesce_groups(
+                group_configs, source.default_interval, config.coalesce_max_gap
+            )
         self._groups = [
-            MetricGroup(self, group_config) for group_config in config.groups
+            MetricGroup(self, group_config) for group_config in group_configs
         ]
+        self._groups_by_interval: dict[Timedelta, list[MetricGroup]] = {}
+        for group in self._groups:
+            interval = group.sampling_interval
+            self._groups_by_interval.setdefault(interval, []).append(group)
 
     @staticmethod
-    def _parse_hosts(hosts: str | list[str]) -> list[str]:
+    def _parse_hosts(hosts: str | list[str]) -> Sequence[str]:
         if isinstance(hosts, str):
-            return cast(list[str], expand_hostlist(hosts))
+            return config_model.expand_hostlist(hosts)
         assert isinstance(hosts, list)
         assert all(isinstance(host, str) for host in hosts)
         return hosts
@@ -306,12 +381,13 @@ class Host:
         cls,
         source: "ModbusSource",
         host_config: config_model.Host,
+        skipped: list[str],
     ) -> AsyncIterator["Host"]:
         hosts = cls._parse_hosts(host_config.hosts)
         names = cls._parse_hosts(host_config.names)
         if len(hosts) != len(names):
             raise ConfigError("Number of names and hosts differ")
-        descriptions: list[str]
+        descriptions: Sequence[str]
         if host_config.descriptions is not None:
             descriptions = cls._parse_hosts(host_config.descriptions)
             if len(hosts) != len(descriptions):
@@ -346,13 +422,25 @@ class Host:
                 logger.exception(
                     f"Failed to connect to: {host} ({name}). Skipping.", replacer
                 )
+                skipped.append(name)
 
     @classmethod
     async def create_from_host_configs(
-        cls, source: "ModbusSource", host_configs: Sequence[config_model.Host]
+        cls,
+        source: "ModbusSource",
+        host_configs: Sequence[config_model.Host],
+        skipped: Optional[list[str]] = None,
     ) -> AsyncIterator["Host"]:
+        """
+        Hosts that cannot be reached are skipped,
+        their names are appended to ``skipped`` if given.
+        """
+        if skipped is None:
+            skipped = []
         for host_config in host_configs:
-            async for host in cls._create_from_host_config(source, host_config):
+            async for host in cls._create_from_host_config(
+                source, host_config, skipped
+            ):
                 yield host
 
     @property
@@ -371,19 +459,67 @@ class Host:
             for metric, metadata in group.metadata.items()
         }
 
+    async def _sampling_task(
+        self,
+        interval: Timedelta,
+        groups: Sequence[MetricGroup],
+        stop_future: asyncio.Future[None],
+        client: ModbusClient,
+    ) -> None:
+        """
+        Update all groups with the same sampling interval together, such that they
+        share a single timer instead of waking up the event loop for each group.
+        """
+        # Similar code as to metricq.IntervalSource.task, but for MetricGroups
+        deadline = Timestamp.now()
+        deadline -= deadline % interval  # Align deadlines to the interval
+        while True:
+            await asyncio.gather(*(group.update(client) for group in groups))
+
+            now = Timestamp.now()
+            deadline += interval
+
+            if (missed := (now - deadline)) > Timedelta(0):
+                missed_intervals = 1 + (missed // interval)
+                logger.warning(
+                    "Missed deadline {} by {} it is now {} (x{})",
+                    deadline,
+                    missed,
+                    now,
+                    missed_intervals,
+                )
+                deadline += interval * missed_intervals
+
+            timeout = deadline - now
+            try:
+                # Shield, because the timeout must not cancel the shared stop future.
+                # Exceptions set on the stop future are raised here.
+                await asyncio.wait_for(asyncio.shield(stop_future), timeout=timeout.s)
+                return
+            except asyncio.TimeoutError:
+                pass
+
     async def _connect_and_run(self, stop_future: asyncio.Future[None]) -> None:
-        logger.info("Opening connection to {}:{}", self.host, self.port)
-        reader, writer = await asyncio.open_connection(self.host, self.port)
-        try:
-            client = AsyncTCPClient((reader, writer))
-            lock = asyncio.Lock()
-            await asyncio.gather(
-                *[group.task(stop_future, client, lock) for group in self._groups]
-            )
-        finally:
-            with suppress(Exception):
-                writer.close()
-                await writer.wait_closed()
+        logger.info("Connecting to {}:{}", self.host, self.port)
+        # Hosts behind the same gateway share the connection
+        async with self.source.connection_pool.connect(
+            self.host, self.port, self._max_requests_in_flight
+        ) as client:
+            tasks = [
+                asyncio.create_task(
+                    self._sampling_task(interval, groups, stop_future, client)
+                )
+                for interval, groups in self._groups_by_interval.items()
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # gather does not cancel the other tasks if one fails. The pooled
+                # connection may stay open for other hosts, so they would keep
+                # sampling alongside the tasks of the retry.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
     async def task(self, stop_future: asyncio.Future[None]) -> None:
         retry = True
@@ -398,25 +534,40 @@ class Host:
 
 class ModbusSource(Source):
     default_interval: Optional[Timedelta] = None
+    coalesce: bool = True
     hosts: Optional[list[Host]] = None
+    _config: Optional[config_model.Source] = None
     _host_task_stop_future: Optional[asyncio.Future[None]] = None
     _host_task: Optional[asyncio.Task[None]] = None
 
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.connection_pool = ConnectionPool()
+
     @rpc_handler("config")
     async def _on_config(
         self,
         **kwargs: Any,
     ) -> None:
-        config = config_model.Source(**kwargs)
+        config = config_model.SOURCE_ADAPTER.validate_python(kwargs)
+        if self._host_task is not None and config == self._config:
+            # The models are frozen, so equality means nothing changed, e.g., only
+            # the couchdb revision. Keep the running hosts and their connections.
+            logger.info("Configuration unchanged, keeping running hosts")
+            return
+
+        self._config = None
         self.default_interval = extract_interval(config)
+        self.coalesce = config.coalesce
 
-        if self.hosts is not None:
+        if self._host_task is not None:
             await self._stop_host_tasks()
 
+        skipped: list[str] = []
         self.hosts = [
-            host async for host in Host.create_from_host_configs(self, config.hosts)
+            host
+            async for host in Host.create_from_host_configs(self, config.hosts, skipped)
         ]
-
         await self.declare_metrics(
             {
                 metric: metadata
@@ -426,6 +577,10 @@ class ModbusSource(Source):
         )
 
         self._create_host_tasks()
+        # Only remember complete and running configurations, such that sending the
+        # same configuration again retries skipped hosts or failed declarations
+        if not skipped:
+            self._config = config
 
     async def _stop_host_tasks(self) -> None:
         assert self._host_task_stop_future is not None
@@ -0,0 +1,5 @@
+import os
+
+# Must be set before the config models are defined, pydantic looks up plugins
+# (scanning the entry points of all installed distributions) when building them.
+os.environ.setdefault("PYDANTIC_DISABLE_PLUGINS", "1")
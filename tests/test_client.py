@@ -0,0 +1,184 @@
+import asyncio
+import struct
+
+import pytest
+
+from metricq_source_modbus.client import (
+    ConnectionPool,
+    ModbusClient,
+    ModbusError,
+    open_client,
+)
+
+
+async def _serve_reversed(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """
+    Collect two requests and answer them in reverse order, returning the register
+    addresses as values. Address 0xFFFF results in an exception response.
+    """
+    requests = []
+    for _ in range(2):
+        header = await reader.readexactly(7)
+        transaction_id, _, length, unit_id = struct.unpack(">HHHB", header)
+        pdu = await reader.readexactly(length - 1)
+        requests.append((transaction_id, unit_id, pdu))
+    for transaction_id, unit_id, pdu in reversed(requests):
+        function_code, address, quantity = struct.unpack(">BHH", pdu)
+        if address == 0xFFFF:
+            response = struct.pack(">BB", function_code | 0x80, 2)
+        else:
+            values = range(address, address + quantity)
+            response = struct.pack(
+                f">BB{quantity}H", function_code, 2 * quantity, *values
+            )
+        writer.write(
+            struct.pack(">HHHB", transaction_id, 0, len(response) + 1, unit_id)
+            + response
+        )
+    await writer.drain()
+    writer.close()
+
+
+async def _run_reversed(*requests: tuple[int, int]) -> list[bytes | BaseException]:
+    server = await asyncio.start_server(_serve_reversed, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        client = await open_client("127.0.0.1", port)
+        try:
+            return await asyncio.gather(
+                *(
+                    client.read_input_registers(1, address, quantity)
+                    for address, quantity in requests
+                ),
+                return_exceptions=True,
+            )
+        finally:
+            await client.close()
+
+
+def test_pipelined_out_of_order() -> None:
+    first, second = asyncio.run(_run_reversed((10, 2), (20, 3)))
+    assert first == struct.pack(">2H", 10, 11)
+    assert second == struct.pack(">3H", 20, 21, 22)
+
+
+def test_exception_response() -> None:
+    first, second = asyncio.run(_run_reversed((10, 2), (0xFFFF, 1)))
+    assert first == struct.pack(">2H", 10, 11)
+    assert isinstance(second, ModbusError)
+
+
+async def _serve_close(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    await reader.readexactly(12)
+    writer.close()
+
+
+def test_connection_closed() -> None:
+    async def run() -> None:
+        server = await asyncio.start_server(_serve_close, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            client = await open_client("127.0.0.1", port)
+            try:
+                with pytest.raises(ConnectionError):
+                    await client.read_input_registers(1, 10, 2)
+                with pytest.raises(ConnectionError):
+                    await client.read_input_registers(1, 10, 2)
+            finally:
+                await client.close()
+
+    asyncio.run(run())
+
+
+class _RecordingTransport(asyncio.Transport):
+    def __init__(self) -> None:
+        super().__init__()
+        self.written = bytearray()
+
+    def write(self, data: bytes | bytearray | memoryview) -> None:
+        self.written += data
+
+    def abort(self) -> None:
+        pass
+
+
+def _feed(client: ModbusClient, data: bytes) -> None:
+    buffer = client.get_buffer(len(data))
+    buffer[: len(data)] = data
+    client.buffer_updated(len(data))
+
+
+def test_fragmented_frames() -> None:
+    async def run() -> None:
+        client = ModbusClient()
+        transport = _RecordingTransport()
+        client.connection_made(transport)
+        requests = [
+            asyncio.create_task(client.read_input_registers(1, address, 1))
+            for address in (10, 20)
+        ]
+        await asyncio.sleep(0)
+        transaction_ids = [
+            struct.unpack_from(">H", transport.written, offset)[0] for offset in (0, 12)
+        ]
+        stream = b"".join(
+            struct.pack(">HHHBBBH", transaction_id, 0, 5, 1, 4, 2, value)
+            for transaction_id, value in zip(transaction_ids, (42, 43))
+        )
+        # Split within the first header and within the second frame
+        for chunk in (stream[:3], stream[3:15], stream[15:]):
+            _feed(client, chunk)
+        assert await asyncio.gather(*requests) == [
+            struct.pack(">H", 42),
+            struct.pack(">H", 43),
+        ]
+
+    asyncio.run(run())
+
+
+def test_truncated_frame() -> None:
+    async def run() -> None:
+        client = ModbusClient()
+        transport = _RecordingTransport()
+        client.connection_made(transport)
+        request = asyncio.create_task(client.read_input_registers(1, 10, 1))
+        await asyncio.sleep(0)
+        (transaction_id,) = struct.unpack_from(">H", transport.written)
+        # Exception response without the exception code
+        _feed(client, struct.pack(">HHHBB", transaction_id, 0, 2, 1, 0x84))
+        with pytest.raises(ModbusError):
+            await asyncio.wait_for(request, timeout=1)
+        assert client.closed
+
+    asyncio.run(run())
+
+
+async def _serve_idle(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    await reader.read()
+    writer.close()
+
+
+def test_connection_pool() -> None:
+    async def run() -> None:
+        server = await asyncio.start_server(_serve_idle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            pool = ConnectionPool()
+            async with pool.connect("127.0.0.1", port) as first:
+                async with pool.connect("127.0.0.1", port) as second:
+                    assert first is second
+                async with pool.connect("127.0.0.1", port, 2) as other:
+                    assert other is not first
+                assert other.closed
+                assert not first.closed
+            assert first.closed
+            async with pool.connect("127.0.0.1", port) as third:
+                assert third is not first
+
+    asyncio.run(run())
@@ -1,21 +1,39 @@
+import json
+from collections.abc import Callable, Mapping
+from types import MappingProxyType
+from typing import Any, Final
+
 import pytest
-from pydantic import ValidationError
-
-from metricq_source_modbus import config_model
-
-
-def test_simple() -> None:
-    source = config_model.Source(
-        **{
-            "interval": "100ms",
-            "hosts": [
-                {
-                    "hosts": "test[1-3]",
-                    "port": 502,
-                    "names": "example.test[1-3]",
-                    "slave_id": 1,
-                    "description": "Test",
-                    "groups": [
+from pydantic import BaseModel, ValidationError
+
+from metricq_source_modbus.config_model import (
+    SOURCE_ADAPTER,
+    Group,
+    Host,
+    Metric,
+    Source,
+    StringConfig,
+    expand_hostlist,
+)
+
+
+def _host_stub(groups: list[dict[str, Any]]) -> dict[str, Any]:
+    """A fresh host entry with the defaults shared by most payloads"""
+    return {
+        "hosts": "test[1-3]",
+        "names": "example.test[1-3]",
+        "slave_id": 1,
+        "groups": groups,
+    }
+
+
+_SIMPLE_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "interval": "100ms",
+        "hosts": [
+            {
+                **_host_stub(
+                    [
                         {
                             "metrics": {
                                 "foo": {
@@ -25,52 +43,30 @@ def test_simple() -> None:
                                 }
                             }
                         }
-                    ],
-                },
-            ],
-        }  # type: ignore # mypy does not like this, but this is about parsing
-    )
-    assert source.hosts[0].groups[0].metrics["foo"].address == 42
-
-
-def test_minimal() -> None:
-    """Not actually semantically valid because of missing interval"""
-    config_model.Source(
-        **{
-            "_ref": "abcd",
-            "_rev": "efgh",
-            "hosts": [
-                {
-                    "hosts": "test[1-3]",
-                    "names": "example.test[1-3]",
-                    "slave_id": 1,
-                    "groups": [
-                        {
-                            "metrics": {
-                                "foo": {
-                                    "address": 0,
-                                }
-                            }
-                        }
-                    ],
-                },
-            ],
-        }  # type: ignore # mypy does not like this, but this is about parsing
-    )
+                    ]
+                ),
+                "port": 502,
+                "description": "Test",
+            },
+        ],
+    }
+)
 
+_MINIMAL_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "_ref": "abcd",
+        "_rev": "efgh",
+        "hosts": [_host_stub([{"metrics": {"foo": {"address": 0}}}])],
+    }
+)
 
-def test_long() -> None:
-    config_model.Source(
-        **{
-            "interval": "100ms",
-            "hosts": [
-                {
-                    "hosts": "test[1-3]",
-                    "port": 502,
-                    "names": "example.test[1-3]",
-                    "slave_id": 1,
-                    "description": "Test",
-                    "groups": [
+_LONG_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "interval": "100ms",
+        "hosts": [
+            {
+                **_host_stub(
+                    [
                         {
                             "metrics": {
                                 "foo.power": {
@@ -89,154 +85,240 @@ def test_long() -> None:
                                 }
                             }
                         },
-                    ],
-                },
-                {
-                    "hosts": "toast[1-5]",
-                    "port": 505,
-                    "names": "example.toast[1-5]",
-                    "slave_id": 17,
-                    "description": "Nice and crispy",
-                    "groups": [
-                        {
-                            "interval": "200ms",
-                            "metrics": {
-                                "foo.power": {
-                                    "address": 1900,
-                                    "description": "Some foo example",
-                                    "unit": "W",
-                                },
-                                "bar.power": {
-                                    "address": 1902,
-                                    "description": "Some bar example",
-                                    "unit": "W",
-                                },
+                    ]
+                ),
+                "port": 502,
+                "description": "Test",
+            },
+            {
+                "hosts": "toast[1-5]",
+                "port": 505,
+                "names": "example.toast[1-5]",
+                "slave_id": 17,
+                "description": "Nice and crispy",
+                "groups": [
+                    {
+                        "interval": "200ms",
+                        "metrics": {
+                            "foo.power": {
+                                "address": 1900,
+                                "description": "Some foo example",
+                                "unit": "W",
                             },
-                        }
-                    ],
-                },
-            ],
-        }  # type: ignore # mypy does not like this, but this is about parsing
-    )
-
-
-def test_extra() -> None:
-    with pytest.raises(ValidationError):
-        config_model.Source(
-            **{
-                "hosts": [
+                            "bar.power": {
+                                "address": 1902,
+                                "description": "Some bar example",
+                                "unit": "W",
+                            },
+                        },
+                    }
+                ],
+            },
+        ],
+    }
+)
+
+_EXTRA_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "hosts": [
+            _host_stub(
+                [
                     {
-                        "hosts": "test[1-3]",
-                        "names": "example.test[1-3]",
-                        "slave_id": 1,
-                        "groups": [
-                            {
-                                "metrics": {
-                                    "foo": {
-                                        "address": 0,
-                                        "descryption": "Find the tpyo",
-                                    }
-                                }
+                        "metrics": {
+                            "foo": {
+                                "address": 0,
+                                "descryption": "Find the tpyo",
                             }
-                        ],
-                    },
-                ],
-            }  # type: ignore # mypy does not like this, but this is about parsing
-        )
+                        }
+                    }
+                ]
+            )
+        ],
+    }
+)
 
+_MISSING_ADDRESS_METRIC_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType({})
+
+_WRONG_ADDRESS_TYPE_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "interval": "100ms",
+        "hosts": [_host_stub([{"metrics": {"foo": {"address": "0"}}}])],
+    }
+)
+
+_INVALID_ADDRESS_METRIC_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {"address": ""}
+)
+
+_EMPTY_METRICS_GROUP_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {"metrics": {}}
+)
+
+_EMPTY_GROUPS_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "interval": "100ms",
+        "hosts": [_host_stub([])],
+    }
+)
+
+_EMPTY_HOSTS_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "interval": "100ms",
+        "hosts": [],
+    }
+)
+
+_REVISION_PAYLOAD: Final[Mapping[str, Any]] = MappingProxyType(
+    {
+        "interval": "100ms",
+        "hosts": [_host_stub([{"metrics": {"foo": {"address": 0}}}])],
+    }
+)
 
-def test_missing_address() -> None:
-    with pytest.raises(ValidationError):
-        config_model.Source(
-            **{
-                "interval": "100ms",
-                "hosts": [
-                    {
-                        "hosts": "test[1-3]",
-                        "names": "example.test[1-3]",
-                        "slave_id": 1,
-                        "groups": [{"metrics": {"foo": {}}}],
-                    },
-                ],
-            }  # type: ignore # mypy does not like this, but this is about parsing
-        )
+
+_VALID_PAYLOADS: Final[dict[str, Mapping[str, Any]]] = {
+    "simple": _SIMPLE_PAYLOAD,
+    "minimal": _MINIMAL_PAYLOAD,
+    "long": _LONG_PAYLOAD,
+    "wrong_address_type": _WRONG_ADDRESS_TYPE_PAYLOAD,
+}
+
+_VALID_JSON_PAYLOADS: Final[dict[str, bytes]] = {
+    name: json.dumps(dict(payload)).encode()
+    for name, payload in _VALID_PAYLOADS.items()
+}
+"""Serialized once at import, configurations are stored as JSON documents"""
+
+
+@pytest.fixture(scope="session")
+def simple_source() -> Source:
+    """The models are frozen, so tests can share a single validated instance"""
+    return SOURCE_ADAPTER.validate_python(_SIMPLE_PAYLOAD)
+
+
+def test_simple(simple_source: Source) -> None:
+    assert simple_source.hosts[0].groups[0].metrics["foo"].address == 42
+
+
+def test_simple_defaults(simple_source: Source) -> None:
+    assert simple_source.coalesce
+    host = simple_source.hosts[0]
+    assert host.max_requests_in_flight == 1
+    assert host.coalesce_max_gap == 0
+    assert host.strings is None
+    group = host.groups[0]
+    assert group.interval is None
+    assert not group.double_sample
+    assert group.metrics["foo"].chunk_size is None
+
+
+def test_minimal() -> None:
+    """Not actually semantically valid because of missing interval"""
+    SOURCE_ADAPTER.validate_python(_MINIMAL_PAYLOAD)
+
+
+def test_long() -> None:
+    SOURCE_ADAPTER.validate_python(_LONG_PAYLOAD)
 
 
 def test_wrong_address_type() -> None:
     """Pydantic will convert wrong types if possible"""
-    config = config_model.Source(
-        **{
-            "interval": "100ms",
-            "hosts": [
-                {
-                    "hosts": "test[1-3]",
-                    "names": "example.test[1-3]",
-                    "slave_id": 1,
-                    "groups": [{"metrics": {"foo": {"address": "0"}}}],
-                },
-            ],
-        }  # type: ignore # mypy does not like this, but this is about parsing
-    )
+    config = SOURCE_ADAPTER.validate_python(_WRONG_ADDRESS_TYPE_PAYLOAD)
     assert config.hosts[0].groups[0].metrics["foo"].address == 0
     assert isinstance(config.hosts[0].groups[0].metrics["foo"].address, int)
 
 
-def test_invalid_address() -> None:
-    with pytest.raises(ValidationError):
-        config_model.Source(
-            **{
-                "interval": "100ms",
-                "hosts": [
-                    {
-                        "hosts": "test[1-3]",
-                        "names": "example.test[1-3]",
-                        "slave_id": 1,
-                        "groups": [{"metrics": {"foo": {"address": ""}}}],
-                    },
-                ],
-            }  # type: ignore # mypy does not like this, but this is about parsing
-        )
+@pytest.mark.parametrize(
+    ("validate", "payload", "error_type"),
+    [
+        # Source ignores extra fields, nested models must still forbid them
+        pytest.param(
+            SOURCE_ADAPTER.validate_python,
+            _EXTRA_PAYLOAD,
+            "extra_forbidden",
+            id="extra",
+        ),
+        pytest.param(
+            Metric.model_validate,
+            _MISSING_ADDRESS_METRIC_PAYLOAD,
+            "missing",
+            id="missing_address",
+        ),
+        pytest.param(
+            Metric.model_validate,
+            _INVALID_ADDRESS_METRIC_PAYLOAD,
+            "int_parsing",
+            id="invalid_address",
+        ),
+        pytest.param(
+            Group.model_validate,
+            _EMPTY_METRICS_GROUP_PAYLOAD,
+            "too_short",
+            id="empty_metrics",
+        ),
+        pytest.param(
+            SOURCE_ADAPTER.validate_python,
+            _EMPTY_GROUPS_PAYLOAD,
+            "too_short",
+            id="empty_groups",
+        ),
+        pytest.param(
+            SOURCE_ADAPTER.validate_python,
+            _EMPTY_HOSTS_PAYLOAD,
+            "too_short",
+            id="empty_hosts",
+        ),
+    ],
+)
+def test_invalid(
+    validate: Callable[[Any], object], payload: Mapping[str, Any], error_type: str
+) -> None:
+    """
+    Payloads are validated as full documents where the outer models matter,
+    otherwise only the subtree that is rejected
+    """
+    with pytest.raises(ValidationError) as exc_info:
+        validate(payload)
+    # Only look at the error types, without rendering urls or messages
+    errors = exc_info.value.errors(include_url=False, include_context=False)
+    assert [error["type"] for error in errors] == [error_type]
 
 
-def test_empty_metrics() -> None:
-    with pytest.raises(ValidationError):
-        config_model.Source(
-            **{
-                "interval": "100ms",
-                "hosts": [
-                    {
-                        "hosts": "test[1-3]",
-                        "names": "example.test[1-3]",
-                        "slave_id": 1,
-                        "groups": [{"metrics": {}}],
-                    },
-                ],
-            }  # type: ignore # mypy does not like this, but this is about parsing
+def test_equal_revisions() -> None:
+    """Reconfiguration relies on unchanged configs comparing equal"""
+    configs = [
+        SOURCE_ADAPTER.validate_python(
+            {**_REVISION_PAYLOAD, "_id": "source-modbus", "_rev": revision}
         )
+        for revision in ("1-abcd", "2-efgh")
+    ]
+    assert configs[0] == configs[1]
 
 
-def test_empty_groups() -> None:
-    with pytest.raises(ValidationError):
-        config_model.Source(
-            **{
-                "interval": "100ms",
-                "hosts": [
-                    {
-                        "hosts": "test[1-3]",
-                        "names": "example.test[1-3]",
-                        "slave_id": 1,
-                        "groups": [],
-                    },
-                ],
-            }  # type: ignore # mypy does not like this, but this is about parsing
-        )
+@pytest.mark.parametrize(
+    "model",
+    [
+        Metric,
+        Group,
+        StringConfig,
+        Host,
+        Source,
+    ],
+)
+def test_schema_built_at_import(model: type[BaseModel]) -> None:
+    """No test or config update should pay for building the validators lazily"""
+    assert model.__pydantic_complete__
 
 
-def test_empty_hosts() -> None:
-    with pytest.raises(ValidationError):
-        config_model.Source(
-            **{
-                "interval": "100ms",
-                "hosts": [],
-            }  # type: ignore # mypy does not like this, but this is about parsing
-        )
+@pytest.mark.parametrize("name", _VALID_PAYLOADS)
+def test_json(name: str) -> None:
+    """Validating directly from JSON must yield the same configuration"""
+    assert SOURCE_ADAPTER.validate_json(
+        _VALID_JSON_PAYLOADS[name]
+    ) == SOURCE_ADAPTER.validate_python(_VALID_PAYLOADS[name])
+
+
+def test_expand_hostlist() -> None:
+    hosts = expand_hostlist("example.test[1-3]")
+    assert hosts == ("example.test1", "example.test2", "example.test3")
+    assert expand_hostlist("example.test[1-3]") is hosts
@@ -0,0 +1,38 @@
+from string import Template
+
+import pytest
+
+from metricq_source_modbus.read_strings import StringReplacer
+
+_MAPPING = {"foo": "Foo", "foo_bar": "Foo'Bar", "room": " E 42 ", "-x": "X"}
+
+
+@pytest.mark.parametrize(
+    "description",
+    [
+        "",
+        "No placeholders",
+        "$foo",
+        "$foo $room",
+        "${foo}bar",
+        "$foobar",
+        "$foo_bar",
+        "$FOO",
+        "$unknown ${unknown}",
+        "$$foo",
+        "$ $",
+        "${foo",
+        "$-x",
+        "Meter $room, $foo.$foo_bar",
+    ],
+)
+def test_like_template(description: str) -> None:
+    replacer = StringReplacer(_MAPPING)
+    expected = Template(description).safe_substitute(
+        {key: StringReplacer.sanitize(value) for key, value in _MAPPING.items()}
+    )
+    assert replacer(description) == expected
+
+
+def test_empty_mapping() -> None:
+    assert StringReplacer({})("$foo $$") == "$foo $$"
@@ -0,0 +1,368 @@
+import asyncio
+import struct
+from typing import Any, Optional
+from unittest.mock import AsyncMock
+
+import pytest
+from metricq import Timedelta, Timestamp
+from metricq.datachunk_pb2 import DataChunk
+from metricq.source_metric import SourceMetric
+
+from metricq_source_modbus import config_model
+from metricq_source_modbus.client import ConnectionPool, ModbusError
+from metricq_source_modbus.read_strings import StringReplacer
+from metricq_source_modbus.source import (
+    Host,
+    ModbusSource,
+    chunk_complete,
+    coalesce_groups,
+)
+
+FAILING_ADDRESS = 1000
+"""Reads starting at this register address result in an exception response"""
+
+
+class _FakeSource:
+    """The parts of :class:`ModbusSource` used by hosts, recording sent values"""
+
+    def __init__(self) -> None:
+        self.default_interval = Timedelta.from_s(1)
+        self.coalesce = False
+        self.connection_pool = ConnectionPool()
+        self.chunks: dict[str, list[list[float]]] = {}
+
+    def __getitem__(self, id: str) -> SourceMetric:
+        self.chunks[id] = []
+        return SourceMetric(id, self)  # type: ignore
+
+    async def _send(self, id: str, chunk: DataChunk) -> None:
+        self.chunks[id].append(list(chunk.value))
+
+
+class _FakeClient:
+    """Returns the given frames as responses to consecutive requests"""
+
+    def __init__(self, *frames: bytes) -> None:
+        self.request_semaphore = asyncio.Semaphore()
+        self._frames = list(frames)
+
+    async def read_input_registers_into(
+        self, slave_id: int, starting_address: int, buffer: bytearray
+    ) -> None:
+        buffer[:] = self._frames.pop(0)
+
+
+def _frame(num_registers: int, values: dict[int, float]) -> bytes:
+    """Register contents with big-endian floats at the given register offsets"""
+    frame = bytearray(2 * num_registers)
+    for offset, value in values.items():
+        struct.pack_into(">f", frame, 2 * offset, value)
+    return bytes(frame)
+
+
+def _host(source: _FakeSource, name: str, port: int, **kwargs: Any) -> Host:
+    return Host(
+        source,  # type: ignore
+        host="127.0.0.1",
+        name=name,
+        description="",
+        replacer=StringReplacer({}),
+        config=config_model.Host.model_validate(
+            {"hosts": "127.0.0.1", "port": port, "names": name, **kwargs}
+        ),
+    )
+
+
+async def _serve_registers(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Answer read requests with zeros, until the client closes the connection"""
+    try:
+        while True:
+            header = await reader.readexactly(7)
+            transaction_id, _, length, unit_id = struct.unpack(">HHHB", header)
+            function_code, address, quantity = struct.unpack(
+                ">BHH", await reader.readexactly(length - 1)
+            )
+            if address == FAILING_ADDRESS:
+                response = struct.pack(">BB", function_code | 0x80, 2)
+            else:
+                response = struct.pack(">BB", function_code, 2 * quantity)
+                response += bytes(2 * quantity)
+            writer.write(
+                struct.pack(">HHHB", transaction_id, 0, len(response) + 1, unit_id)
+                + response
+            )
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+def _group(*addresses: int, **kwargs: object) -> config_model.Group:
+    return config_model.Group.model_validate(
+        {
+            "metrics": {f"m{address}": {"address": address} for address in addresses},
+            **kwargs,
+        }
+    )
+
+
+def test_coalesce_adjacent() -> None:
+    groups = coalesce_groups([_group(0, 2), _group(4, 6)], Timedelta.from_s(1))
+    assert len(groups) == 1
+    assert list(groups[0].metrics) == ["m0", "m2", "m4", "m6"]
+
+
+def test_coalesce_gap() -> None:
+    groups = coalesce_groups(
+        [_group(100), _group(0), _group(18)], Timedelta.from_s(1), max_gap=16
+    )
+    assert [list(group.metrics) for group in groups] == [["m0", "m18"], ["m100"]]
+
+
+def test_coalesce_no_gap_by_default() -> None:
+    groups = coalesce_groups([_group(0), _group(2), _group(6)], Timedelta.from_s(1))
+    assert [list(group.metrics) for group in groups] == [["m0", "m2"], ["m6"]]
+
+
+def test_coalesce_request_limit() -> None:
+    groups = coalesce_groups(
+        [_group(*range(0, 124, 2)), _group(124)], Timedelta.from_s(1)
+    )
+    assert [len(group.metrics) for group in groups] == [62, 1]
+
+
+def test_coalesce_same_metric_name() -> None:
+    other = config_model.Group.model_validate({"metrics": {"m0": {"address": 2}}})
+    groups = coalesce_groups([_group(0), other], Timedelta.from_s(1))
+    assert groups == [_group(0), other]
+
+
+def test_coalesce_different_interval() -> None:
+    groups = coalesce_groups(
+        [_group(0), _group(2, interval="1s"), _group(4, interval=2)],
+        Timedelta.from_s(1),
+    )
+    assert [list(group.metrics) for group in groups] == [["m0", "m2"], ["m4"]]
+
+
+def test_coalesce_different_double_sample() -> None:
+    groups = coalesce_groups(
+        [_group(0), _group(2, double_sample=True)], Timedelta.from_s(1)
+    )
+    assert len(groups) == 2
+
+
+def test_coalesce_keeps_double_sample() -> None:
+    """Duplicates are detected per group, so these groups must not be merged"""
+    configs = [_group(0, double_sample=True), _group(2, double_sample=True)]
+    groups = coalesce_groups(configs, Timedelta.from_s(1))
+    assert groups == configs
+
+
+def test_coalesce_result_valid() -> None:
+    """Coalescing bypasses validation, the result must still pass it"""
+    (group,) = coalesce_groups([_group(0, 2), _group(4)], Timedelta.from_s(1))
+    assert config_model.Group.model_validate(group.model_dump()) == group
+
+
+def test_failing_host_stops_sampling() -> None:
+    """
+    A failing group must stop all sampling of its host, even if the shared
+    connection stays open for another host
+    """
+
+    async def run() -> None:
+        server = await asyncio.start_server(_serve_registers, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            source = _FakeSource()
+            failing = _host(
+                source,
+                "failing",
+                port,
+                slave_id=1,
+                groups=[
+                    {"metrics": {"broken": {"address": FAILING_ADDRESS}}},
+                    {
+                        "interval": "10ms",
+                        "metrics": {"fast": {"address": 0, "chunk_size": 1}},
+                    },
+                ],
+            )
+            working = _host(
+                source,
+                "working",
+                port,
+                slave_id=2,
+                groups=[{"interval": "10ms", "metrics": {"ok": {"address": 0}}}],
+            )
+            stop_future = asyncio.get_running_loop().create_future()
+            working_task = asyncio.create_task(working._connect_and_run(stop_future))
+            await asyncio.sleep(0.05)
+
+            # Timeouts, such that a regression fails instead of hanging
+            with pytest.raises(ModbusError):
+                await asyncio.wait_for(failing._connect_and_run(stop_future), 1)
+            samples = len(source.chunks["failing.fast"])
+            await asyncio.sleep(0.1)
+            assert len(source.chunks["failing.fast"]) == samples
+
+            stop_future.set_result(None)
+            await asyncio.wait_for(working_task, 1)
+
+    asyncio.run(run())
+
+
+def _update_group(
+    metrics: dict[str, Any], *frames: bytes, **kwargs: Any
+) -> _FakeSource:
+    """Update a single group with each of the frames and return the sent chunks"""
+    source = _FakeSource()
+    host = _host(
+        source, "host", 502, slave_id=1, groups=[{"metrics": metrics, **kwargs}]
+    )
+    (group,) = host._groups
+    client = _FakeClient(*frames)
+
+    async def run() -> None:
+        for _ in frames:
+            await group.update(client)  # type: ignore
+
+    asyncio.run(run())
+    return source
+
+
+def test_group_update_offsets() -> None:
+    source = _update_group(
+        {
+            "even": {"address": 10},
+            "odd": {"address": 13},
+            "last": {"address": 16},
+        },
+        _frame(8, {0: 1.5, 3: -2.25, 6: 1e6}),
+    )
+    assert source.chunks == {
+        "host.even": [[1.5]],
+        "host.odd": [[-2.25]],
+        "host.last": [[1e6]],
+    }
+
+
+def test_group_update_double_sample() -> None:
+    """Only the second of two identical frames in a row is skipped"""
+    source = _update_group(
+        {"foo": {"address": 0}},
+        *(_frame(2, {0: value}) for value in (1.0, 1.0, 1.0, 1.0, 2.0, 2.0)),
+        double_sample=True,
+    )
+    assert source.chunks["host.foo"] == [[1.0], [1.0], [2.0]]
+
+
+def test_group_update_chunk_size() -> None:
+    """Values are only flushed, once a chunk is complete"""
+    source = _update_group(
+        {"foo": {"address": 0, "chunk_size": 3}},
+        *(_frame(2, {0: value}) for value in range(5)),
+    )
+    assert source.chunks["host.foo"] == [[0.0, 1.0, 2.0]]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 3])
+def test_chunk_complete_like_send(chunk_size: int | None) -> None:
+    """Appending and flushing complete chunks must behave like metricq's send"""
+    source = _FakeSource()
+    sent = source["sent"]
+    appended = source["appended"]
+    sent.chunk_size = appended.chunk_size = chunk_size
+
+    async def run() -> None:
+        for value in range(7):
+            timestamp = Timestamp.from_posix_seconds(value)
+            await sent.send(timestamp, value)
+            appended.append(timestamp, value)
+            if chunk_complete(appended):
+                await appended.flush()
+
+    asyncio.run(run())
+    assert source.chunks["appended"] == source.chunks["sent"]
+    assert list(appended.chunk.value) == list(sent.chunk.value)
+
+
+_CONFIG: dict[str, Any] = {
+    "interval": "1s",
+    "hosts": [
+        {
+            "hosts": ["a", "b"],
+            "names": ["a", "b"],
+            "slave_id": 1,
+            "groups": [{"metrics": {"foo": {"address": 0}}}],
+        }
+    ],
+}
+
+
+async def _idle_task(self: Host, stop_future: asyncio.Future[None]) -> None:
+    await stop_future
+
+
+def _configure_twice(
+    monkeypatch: pytest.MonkeyPatch,
+    unreachable: set[str],
+    declare_error: Optional[Exception] = None,
+) -> tuple[Optional[list[Host]], Optional[list[Host]]]:
+    """
+    Send the same configuration twice, with another revision.
+    Hosts in ``unreachable`` fail and ``declare_error`` is raised by declaring the
+    metrics only for the first configuration.
+    Returns the hosts after each of them, the host tasks must run after the second.
+    """
+
+    async def read_strings(host: str, *args: Any) -> StringReplacer:
+        if host in unreachable:
+            raise ConnectionError(f"Cannot connect to {host}")
+        return StringReplacer({})
+
+    monkeypatch.setattr("metricq_source_modbus.source.read_strings", read_strings)
+    monkeypatch.setattr(Host, "task", _idle_task)
+
+    async def run() -> tuple[Optional[list[Host]], Optional[list[Host]]]:
+        source = ModbusSource(token="test", url="amqp://localhost/")
+        monkeypatch.setattr(
+            source, "declare_metrics", AsyncMock(side_effect=[declare_error, None])
+        )
+        if declare_error is None:
+            await source._on_config(**_CONFIG, _rev="1-abcd")
+        else:
+            with pytest.raises(type(declare_error)):
+                await source._on_config(**_CONFIG, _rev="1-abcd")
+        first = source.hosts
+        unreachable.clear()
+        await source._on_config(**_CONFIG, _rev="2-efgh")
+        second = source.hosts
+        assert source._host_task is not None
+        await source._stop_host_tasks()
+        return first, second
+
+    return asyncio.run(run())
+
+
+def test_unchanged_config_keeps_hosts(monkeypatch: pytest.MonkeyPatch) -> None:
+    first, second = _configure_twice(monkeypatch, set())
+    assert first is not None and len(first) == 2
+    assert second is first
+
+
+def test_unchanged_config_retries_skipped_hosts(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    first, second = _configure_twice(monkeypatch, {"b"})
+    assert first is not None and [host.host for host in first] == ["a"]
+    assert second is not None and [host.host for host in second] == ["a", "b"]
+
+
+def test_unchanged_config_retries_failed_declaration(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    first, second = _configure_twice(monkeypatch, set(), RuntimeError("RPC failed"))
+    assert first is not None and len(first) == 2
+    assert second is not None and second is not first